@@ -6,118 +6,224 @@ import re
 from collections import defaultdict
 import tempfile
 import io
+import functools
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import render
 
-# Use session state to avoid reprocessing the template on every interaction
-if 'template_variables' not in st.session_state:
-    st.session_state.template_variables = None
-if 'template_doc' not in st.session_state:
-    st.session_state.template_doc = None
-if 'var_paragraphs_map' not in st.session_state:
-    st.session_state.var_paragraphs_map = None
-if 'csv_data' not in st.session_state:
-    st.session_state.csv_data = None
+# Precompiled pattern reused for every paragraph and table cell
+_VAR_RE = re.compile(r'\{([^{}]+)\}')
+
+# Deflate level for the per-row document XML when fast output is requested
+_FAST_COMPRESSLEVEL = 1
+
+# Below this many rows a process pool costs more to start than it saves
+_PARALLEL_MIN_ROWS = 50
+
+# Streamlit 1.52 added download buttons that only build their data when clicked
+_DEFERRED_DOWNLOADS = tuple(int(part) for part in st.__version__.split('.')[:2]) >= (1, 52)
+
+# Download formats for the processed data: file name and MIME type
+_DOWNLOAD_FORMATS = {
+    'CSV': ('processed_data.csv', 'text/csv'),
+    'Parquet': ('processed_data.parquet', 'application/octet-stream'),
+    'Feather': ('processed_data.feather', 'application/octet-stream'),
+}
+
+def _iter_all_paragraphs(doc):
+    """Yield (index, paragraph) for body paragraphs, then (None, paragraph) for table cells"""
+    yield from enumerate(doc.paragraphs)
+    
+    # doc.tables walks the whole body, so read it once and skip the cell loops when empty
+    tables = doc.tables
+    if tables:
+        for table in tables:
+            for row in table.rows:
+                for cell in row.cells:
+                    for paragraph in cell.paragraphs:
+                        yield None, paragraph
 
 def extract_variables_from_template(doc):
     """Extract all variables in {variable} format from the document more efficiently"""
     variables = set()
-    pattern = r'\{([^{}]+)\}'
     var_paragraphs = defaultdict(list)
     
-    # Process paragraphs and collect variables
-    for i, paragraph in enumerate(doc.paragraphs):
-        matches = re.findall(pattern, paragraph.text)
-        for match in matches:
-            variables.add(match)
-            var_paragraphs[match].append(i)
-    
-    # Also check tables if they exist
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    matches = re.findall(pattern, paragraph.text)
-                    variables.update(matches)
+    # Bind the hot lookups locally for the single pass below
+    findall = _VAR_RE.findall
+    add_variable = variables.add
+    
+    # Process body and table paragraphs together; only body paragraphs are indexed
+    for i, paragraph in _iter_all_paragraphs(doc):
+        for match in findall(paragraph.text):
+            add_variable(match)
+            if i is not None:
+                var_paragraphs[match].append(i)
     
     return list(variables), var_paragraphs
 
-def convert_to_csv(file):
-    """Convert various spreadsheet formats to CSV data"""
+@st.cache_resource(show_spinner=False)
+def _parse_template(file_bytes):
+    """Parse the template once per distinct upload; Streamlit keys the cache on the file bytes"""
+    doc = Document(io.BytesIO(file_bytes))
+    return extract_variables_from_template(doc)
+
+def _merge_placeholder_runs(paragraph):
+    """Collapse a paragraph into its first run when Word has split a {variable} across runs"""
+    runs = paragraph.runs
+    if len(runs) < 2:
+        return
+    
+    # Read each run's text once; every access re-walks the run's XML
+    run_texts = [run.text for run in runs]
+    text = ''.join(run_texts)
+    # Skip the merge only when every occurrence of every placeholder sits inside a single run
+    placeholders = set('{' + match + '}' for match in _VAR_RE.findall(text))
+    if all(sum(run_text.count(placeholder) for run_text in run_texts) == text.count(placeholder) for placeholder in placeholders):
+        return
+    
+    runs[0].text = text
+    for run in runs[1:]:
+        run._element.getparent().remove(run._element)
+
+@st.cache_resource(show_spinner=False)
+def _load_template_parts(file_bytes):
+    """Split the template into a pre-built package of its fixed parts and the raw document XML"""
+    doc = Document(io.BytesIO(file_bytes))
+    
+    for _, paragraph in _iter_all_paragraphs(doc):
+        _merge_placeholder_runs(paragraph)
+    
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    
+    # Styles, relationships, media etc. are identical for every output, so compress them
+    # into a base package once; each row then only appends its own document XML
+    base_buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer) as package, zipfile.ZipFile(base_buffer, 'w', zipfile.ZIP_DEFLATED) as base:
+        for info in package.infolist():
+            if info.filename == render.DOCUMENT_XML:
+                document_info = info
+            else:
+                base.writestr(info, package.read(info))
+        xml_template = package.read(render.DOCUMENT_XML).decode('utf-8')
+    
+    # Keep leading and trailing spaces of substituted values; Word trims them in a plain <w:t>
+    xml_template = xml_template.replace('<w:t>', '<w:t xml:space="preserve">')
+    
+    return base_buffer.getvalue(), xml_template, document_info.date_time
+
+@st.cache_data(show_spinner=False)
+def _auto_match(variables, columns):
+    """Map each variable to the index of the column with the same name ignoring case, or 0"""
+    # Case-folded column lookup; the first matching column wins
+    col_index = {}
+    for j, col in enumerate(columns):
+        col_index.setdefault(str(col).lower(), j)
+    return {var: col_index.get(var.lower(), 0) for var in variables}
+
+def _read_with_fallback(reader, file_bytes, fast_engine, default_engine=None, **kwargs):
+    """Read with an optional faster engine, falling back to the usual one if it is missing or unsupported"""
+    try:
+        return reader(io.BytesIO(file_bytes), engine=fast_engine, **kwargs)
+    except (ImportError, ValueError):
+        # pandas raises ImportError when the engine's package is not installed and
+        # ValueError for engines it does not know or options the engine rejects
+        return reader(io.BytesIO(file_bytes), engine=default_engine, **kwargs)
+
+@st.cache_data(show_spinner=False)
+def load_spreadsheet(file_bytes, file_name):
+    """Load various spreadsheet formats into a DataFrame; CSV is only encoded on download"""
     try:
         # Check file extension
-        file_extension = os.path.splitext(file.name)[1].lower()
+        file_extension = os.path.splitext(file_name)[1].lower()
         
         # Read the file based on the extension
         if file_extension in ['.xlsx', '.xls', '.xlsm', '.xlsb']:
             # Excel files
-            df = pd.read_excel(file)
+            df = _read_with_fallback(pd.read_excel, file_bytes, 'calamine')
         elif file_extension in ['.ods']:
             # OpenDocument Spreadsheet
-            df = pd.read_excel(file, engine='odf')
+            df = _read_with_fallback(pd.read_excel, file_bytes, 'calamine', default_engine='odf')
         elif file_extension in ['.csv']:
             # CSV files
-            df = pd.read_csv(file)
+            df = pd.read_csv(io.BytesIO(file_bytes))
         elif file_extension in ['.tsv', '.txt']:
             # TSV or text files
-            df = pd.read_csv(file, sep='\t')
+            df = pd.read_csv(io.BytesIO(file_bytes), sep='\t')
         else:
             # Try to read as Excel by default
-            df = pd.read_excel(file)
-        
-        # Convert to CSV
-        csv_buffer = io.StringIO()
-        df.to_csv(csv_buffer, index=False)
+            df = pd.read_excel(io.BytesIO(file_bytes))
         
-        return df, csv_buffer.getvalue()
+        return df
     except Exception as e:
-        st.error(f"Error converting file: {str(e)}")
-        return None, None
+        st.error(f"Error reading file: {str(e)}")
+        return None
 
-def generate_documents(df, template_doc, column_mapping, filename_column, output_dir, var_paragraphs_map):
-    """Generate individual documents based on Excel data with improved performance"""
+@st.cache_data(show_spinner=False)
+def _encode_download(df, file_format):
+    """Serialize the processed data for download; cached so repeated clicks reuse the bytes"""
+    if file_format == 'CSV':
+        return df.to_csv(index=False).encode()
+    
+    # Arrow-based formats need string column names, which Excel headers do not guarantee,
+    # and a single type per column, so values in object columns mixing numbers and text become
+    # strings; missing cells stay null rather than turning into 'None' or 'nan'
+    df = df.rename(columns=str)
+    for column in df.select_dtypes('object').columns:
+        df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    buffer = io.BytesIO()
+    if file_format == 'Parquet':
+        df.to_parquet(buffer, compression='zstd', index=False)
+    else:
+        df.to_feather(buffer, compression='lz4')
+    return buffer.getvalue()
+
+def generate_documents_iter(df, template_bytes, column_mapping, filename_column, output_dir, fast_output=False):
+    """Generate individual documents based on Excel data, yielding each output path (None for rows a later row overwrites)"""
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
     
-    # Cache variable patterns for faster replacement
-    var_patterns = {var: re.compile(r'\{' + re.escape(var) + r'\}') for var in column_mapping.keys()}
+    # Work on the raw document XML; every other part of the package is copied as-is
+    base_package, xml_template, document_date_time = _load_template_parts(template_bytes)
     
-    # Process each row in the dataframe
-    doc_count = 0
-    for index, row in df.iterrows():
-        # Create a new document from the template
-        doc = Document()
-        
-        # Pre-calculate all replacements
-        replacements = {var: str(row[column]) for var, column in column_mapping.items()}
-        
-        # Process paragraphs in the template
-        for i, template_para in enumerate(template_doc.paragraphs):
-            new_paragraph = doc.add_paragraph()
-            new_paragraph.style = template_para.style
-            
-            # Only perform replacements if needed
-            text = template_para.text
-            
-            # Check if this paragraph needs processing based on our map
-            variables_to_replace = [var for var in column_mapping.keys() if i in var_paragraphs_map.get(var, [])]
-            
-            if variables_to_replace:
-                for var in variables_to_replace:
-                    pattern = var_patterns[var]
-                    replacement_value = replacements[var]
-                    text = pattern.sub(replacement_value, text)
-            
-            new_paragraph.text = text
-        
-        # Get filename from the selected column
-        filename = str(row[filename_column]).replace(" ", "_")
-        filename = re.sub(r'[^\w\-_\.]', '', filename)  # Remove invalid characters
-        
-        # Save the document
-        output_path = os.path.join(output_dir, f"{filename}.docx")
-        doc.save(output_path)
-        doc_count += 1
+    # Stringify only the columns we need once; plain tuples skip per-row Series and dict building.
+    # str() per value rather than astype(str), which leaves missing cells as NaN on pandas 3
+    needed_columns = list(dict.fromkeys(list(column_mapping.values()) + [filename_column]))
+    rows = [tuple(map(str, row)) for row in df[needed_columns].itertuples(index=False, name=None)]
+    
+    # Later rows overwrite earlier ones with the same file name, so only render the last
+    # occurrence; otherwise pool workers would race on the same path
+    filename_index = needed_columns.index(filename_column)
+    jobs = {}
+    for row in rows:
+        jobs[render.output_filename(row[filename_index])] = row
+    jobs = list(jobs.items())
+    superseded = len(rows) - len(jobs)
     
-    return doc_count
+    compresslevel = _FAST_COMPRESSLEVEL if fast_output else None
+    render_args = (base_package, xml_template, document_date_time, column_mapping, needed_columns, output_dir, compresslevel)
+    
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(jobs) < _PARALLEL_MIN_ROWS:
+        state = render.build_render_state(*render_args)
+        for job in jobs:
+            yield render.render_one(state, job)
+    else:
+        # Rows are independent, so fan them out in chunks to amortize the IPC per row,
+        # and report each chunk as soon as it lands rather than in submission order
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=render.init_worker, initargs=render_args) as executor:
+            futures = [executor.submit(render.render_chunk, jobs[i:i + chunksize]) for i in range(0, len(jobs), chunksize)]
+            for future in as_completed(futures):
+                yield from future.result()
+    
+    # Rows whose file was taken over by a later row still count towards the total, as before
+    for _ in range(superseded):
+        yield None
+
+def generate_documents(df, template_bytes, column_mapping, filename_column, output_dir, fast_output=False):
+    """Generate individual documents based on Excel data, spread across CPU cores for large runs"""
+    return sum(1 for _ in generate_documents_iter(df, template_bytes, column_mapping, filename_column, output_dir, fast_output))
 
 def main():
     st.title("Document Generator")
@@ -135,36 +241,22 @@ def main():
     )
     
     if template_file is not None and spreadsheet_file is not None:
-        # Convert spreadsheet to CSV in the backend
+        # Load the spreadsheet in the backend
         with st.spinner("Processing spreadsheet..."):
-            df, csv_data = convert_to_csv(spreadsheet_file)
+            df = load_spreadsheet(spreadsheet_file.getvalue(), spreadsheet_file.name)
             
             if df is None:
                 st.error("Failed to process the spreadsheet file. Please check the format.")
                 st.stop()
-            
-            # Store CSV data in session state
-            st.session_state.csv_data = csv_data
         
         # Show a preview of the data
         st.subheader("Data Preview")
         st.dataframe(df.head())
         
-        # Process template only when it changes, using session state
-        if template_file != st.session_state.get('last_template_file'):
-            with st.spinner("Processing template..."):
-                template_doc = Document(template_file)
-                variables, var_paragraphs_map = extract_variables_from_template(template_doc)
-                
-                # Store in session state
-                st.session_state.template_doc = template_doc
-                st.session_state.template_variables = variables
-                st.session_state.var_paragraphs_map = var_paragraphs_map
-                st.session_state.last_template_file = template_file
-        
-        variables = st.session_state.template_variables
-        template_doc = st.session_state.template_doc
-        var_paragraphs_map = st.session_state.var_paragraphs_map
+        # Template parsing is cached on the uploaded bytes, so reruns skip it entirely
+        template_bytes = template_file.getvalue()
+        with st.spinner("Processing template..."):
+            variables, _ = _parse_template(template_bytes)
         
         if variables:
             st.header("Step 2: Map Variables to Excel Columns")
@@ -173,23 +265,19 @@ def main():
             column_mapping = {}
             available_columns = df.columns.tolist()
             
+            # Default column for each variable, cached across reruns for the same names
+            default_indexes = _auto_match(tuple(variables), tuple(available_columns))
+            
             # Create a more efficient UI for mapping with default selection when names match
             col1, col2 = st.columns(2)
             for i, var in enumerate(variables):
                 # Determine which column to use for better UI layout
                 current_col = col1 if i % 2 == 0 else col2
                 
-                default_index = 0
-                # Try to find matching column name
-                for j, col in enumerate(available_columns):
-                    if var.lower() == col.lower():
-                        default_index = j
-                        break
-                
                 column_mapping[var] = current_col.selectbox(
                     f"Map '{var}' to column:", 
                     options=available_columns,
-                    index=default_index,
+                    index=default_indexes[var],
                     key=f"mapping_{var}"
                 )
             
@@ -203,18 +291,33 @@ def main():
             # Output directory
             output_dir = st.text_input("Output directory path:", "output_documents", key="output_dir")
             
+            # Lighter compression for bulk runs where file size matters less
+            fast_output = st.checkbox("Fast output (larger files)", value=False, key="fast_output")
+            
+            # Format for downloading the processed data
+            download_format = st.radio("Download format", list(_DOWNLOAD_FORMATS), horizontal=True, key="download_format")
+            
             # Generate button
             if st.button("Generate Documents", key="generate_button"):
-                with st.spinner("Generating documents..."):
-                    num_docs = generate_documents(df, template_doc, column_mapping, filename_column, output_dir, var_paragraphs_map)
+                # Report progress as documents land; only redraw when the percentage moves
+                progress = st.progress(0, text="Generating documents...")
+                num_docs, last_percent = 0, 0
+                for num_docs, _ in enumerate(generate_documents_iter(df, template_bytes, column_mapping, filename_column, output_dir, fast_output), start=1):
+                    percent = num_docs * 100 // len(df)
+                    if percent != last_percent:
+                        progress.progress(percent, text=f"Generating documents... {num_docs}/{len(df)}")
+                        last_percent = percent
+                progress.empty()
                 st.success(f"{num_docs} documents generated successfully in '{output_dir}'!")
                 
-                # Option to download CSV data
+                # Option to download the data, encoded only when actually requested where supported
+                file_name, mime = _DOWNLOAD_FORMATS[download_format]
+                encode_data = functools.partial(_encode_download, df, download_format)
                 st.download_button(
-                    label="Download Processed Data as CSV",
-                    data=st.session_state.csv_data,
-                    file_name="processed_data.csv",
-                    mime="text/csv",
+                    label=f"Download Processed Data as {download_format}",
+                    data=encode_data if _DEFERRED_DOWNLOADS else encode_data(),
+                    file_name=file_name,
+                    mime=mime,
                 )
         else:
             st.warning("No variables found in the template. Make sure to use {variable_name} format.")
@@ -0,0 +1,100 @@
+import os
+import re
+import string
+import zipfile
+from xml.sax.saxutils import escape
+
+# Rendering lives in its own module so process pool workers can unpickle these functions
+# by a stable import path; Streamlit replaces the script's __main__ module on every rerun
+
+# Part of the .docx package that holds the body paragraphs and tables
+DOCUMENT_XML = 'word/document.xml'
+
+# Precompiled pattern for filenames that still contain non-ASCII text
+_FILENAME_SANITIZE_RE = re.compile(r'[^\w\-_\.]')
+
+# ASCII filenames are cleaned with one str.translate pass: spaces become underscores
+# and anything the sanitize pattern would strip is dropped
+_FILENAME_KEEP = set(string.ascii_letters + string.digits + '_-.')
+_FILENAME_TRANS = str.maketrans({c: None for c in map(chr, range(128)) if c not in _FILENAME_KEEP})
+_FILENAME_TRANS[ord(' ')] = '_'
+
+# Characters XML 1.0 does not allow at all; python-docx used to reject them, here they are dropped
+_ILLEGAL_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+# Line breaks and tabs become Word's own elements, as python-docx's .text setter did;
+# each closes the surrounding <w:t> and reopens one that keeps its spaces
+_TEXT_BREAKS = str.maketrans({
+    '\n': '</w:t><w:br/><w:t xml:space="preserve">',
+    '\r': '</w:t><w:br/><w:t xml:space="preserve">',
+    '\t': '</w:t><w:tab/><w:t xml:space="preserve">',
+})
+
+# Up to this many placeholders, chained str.replace calls beat one alternation regex
+_REPLACE_CHAIN_MAX_VARS = 4
+
+# Rendering state inside pool worker processes only, set up once by init_worker.
+# Streamlit sessions share one process, so the in-process path passes its state explicitly
+_render_state = None
+
+def output_filename(value):
+    """Turn a cell value into a safe output file name (without extension)"""
+    filename = value.translate(_FILENAME_TRANS)
+    if not filename.isascii():
+        # Non-ASCII word characters are kept, so leave those to the Unicode-aware pattern
+        filename = _FILENAME_SANITIZE_RE.sub('', filename)
+    return filename
+
+def _xml_text(value):
+    """Encode a cell value for insertion inside a <w:t> element of the document XML"""
+    return escape(_ILLEGAL_XML_RE.sub('', value)).translate(_TEXT_BREAKS)
+
+def build_render_state(base_package, xml_template, document_date_time, column_mapping, needed_columns, output_dir, compresslevel):
+    """Precompute everything render_one needs that does not change from row to row"""
+    # Rows arrive as plain tuples ordered like needed_columns
+    position = {column: i for i, column in enumerate(needed_columns)}
+    
+    # Placeholders are matched as they appear in the XML, i.e. with &, < and > escaped
+    placeholders = [('{' + escape(var) + '}', position[column]) for var, column in column_mapping.items()]
+    placeholder_re = re.compile('|'.join(re.escape(needle) for needle, _ in placeholders)) if placeholders else None
+    use_replace_chain = len(placeholders) <= _REPLACE_CHAIN_MAX_VARS
+    output_prefix = os.path.join(output_dir, '')
+    return (base_package, xml_template, document_date_time, placeholder_re, use_replace_chain, placeholders, output_prefix, compresslevel)
+
+def init_worker(*render_args):
+    """Prepare pool worker state so each row only needs to ship its own values"""
+    global _render_state
+    _render_state = build_render_state(*render_args)
+
+def render_one(state, job):
+    """Write the document for a (filename, row tuple) job and return its output path"""
+    base_package, xml_template, document_date_time, placeholder_re, use_replace_chain, placeholders, output_prefix, compresslevel = state
+    filename, row = job
+    
+    values = [_xml_text(row[index]) for _, index in placeholders]
+    
+    xml = xml_template
+    # A chain would also replace placeholders that appear inside earlier values,
+    # so rows whose values contain braces take the single-pass regex instead
+    if use_replace_chain and not any('{' in value for value in values):
+        for (needle, _), value in zip(placeholders, values):
+            xml = xml.replace(needle, value)
+    elif placeholder_re is not None:
+        # Pre-calculate all replacements, keyed by the full placeholder text
+        replacements = {needle: value for (needle, _), value in zip(placeholders, values)}
+        xml = placeholder_re.sub(lambda m: replacements[m.group(0)], xml)
+    
+    # Save the document: copy the pre-built package, then append this row's document XML
+    output_path = output_prefix + filename + '.docx'
+    document_info = zipfile.ZipInfo(DOCUMENT_XML, date_time=document_date_time)
+    document_info.compress_type = zipfile.ZIP_DEFLATED
+    with open(output_path, 'w+b') as output_file:
+        output_file.write(base_package)
+        with zipfile.ZipFile(output_file, 'a') as package:
+            package.writestr(document_info, xml, compresslevel=compresslevel)
+    
+    return output_path
+
+def render_chunk(jobs):
+    """Render a batch of jobs in a worker process, returning their output paths"""
+    return [render_one(_render_state, job) for job in jobs]
@@ -4,12 +4,13 @@ import sys
 import subprocess
 import platform
 import importlib.util
-import pkg_resources
+import re
+from importlib.metadata import distributions
 
 def check_python_version():
     """Check if Python version is compatible"""
     required_major = 3
-    required_minor = 7
+    required_minor = 8
     
     current_major = sys.version_info.major
     current_minor = sys.version_info.minor
@@ -21,13 +22,18 @@ def check_python_version():
     
     return True
 
-def is_package_installed(package_name):
-    """Check if a package is already installed"""
-    try:
-        pkg_resources.get_distribution(package_name)
-        return True
-    except pkg_resources.DistributionNotFound:
-        return False
+def normalize_package_name(package_name):
+    """Normalize a package name so e.g. python_docx and Python-Docx compare equal"""
+    return re.sub(r"[-_.]+", "-", package_name).lower()
+
+def get_installed_packages():
+    """Collect the normalized names of all installed packages in a single pass"""
+    installed = set()
+    for dist in distributions():
+        name = dist.metadata["Name"]
+        if name:
+            installed.add(normalize_package_name(name))
+    return installed
 
 def check_and_install_requirements():
     """Check if required packages are installed and install only missing ones"""
@@ -38,14 +44,17 @@ def check_and_install_requirements():
         "openpyxl": "3.0.9",
         "odfpy": "1.4.1", 
         "xlrd": "2.0.1",
-        "pyxlsb": "1.0.9"
+        "pyxlsb": "1.0.9",
+        "pyarrow": "10.0.1",
+        "python-calamine": "0.1.7"
     }
     
+    installed_packages = get_installed_packages()
     missing_packages = []
     
     # Check which packages need to be installed
     for package, min_version in requirements.items():
-        if not is_package_installed(package):
+        if normalize_package_name(package) not in installed_packages:
             missing_packages.append(f"{package}>={min_version}")
         else:
             print(f"✅ {package} is already installed")
@@ -78,6 +87,8 @@ def create_requirements_file():
         "odfpy>=1.4.1",
         "xlrd>=2.0.1",
         "pyxlsb>=1.0.9",
+        "pyarrow>=10.0.1",
+        "python-calamine>=0.1.7",
     ]
     
     with open("requirements.txt", "w") as f: